@@ -3,9 +3,15 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import collections
+import contextlib
+import io
+import itertools
 import logging
 import os
 import re
+import sys
+import threading
 import time
 import xml.etree.ElementTree as ET
 
@@ -26,24 +32,100 @@ try:
 except ImportError:
     HAVE_LIBVIRT = False
 
+try:
+    import re2
+    HAVE_RE2 = True
+except ImportError:
+    HAVE_RE2 = False
+
 log = logging.getLogger(__name__)
 
+# Compiled regular expressions of signatures. The re module keeps its own
+# cache, but only for 100 patterns, after which it's flushed as a whole.
+_regex_cache = {}
+_regex_cache_max = 4096
+
+def _compile(pattern, flags=0):
+    """Compile a regular expression, caching the result. If available, RE2
+    is used as it matches in linear time rather than backtracking. Patterns
+    that RE2 doesn't support (e.g., backreferences or lookarounds) and flags
+    other than re.IGNORECASE are handled by the re module."""
+    exp = _regex_cache.get((pattern, flags))
+    if exp is not None:
+        return exp
+
+    if len(_regex_cache) >= _regex_cache_max:
+        _regex_cache.clear()
+
+    if HAVE_RE2 and not flags & ~re.IGNORECASE:
+        try:
+            exp = re2.compile(
+                "(?i)" + pattern if flags & re.IGNORECASE else pattern
+            )
+        except re2.error:
+            pass
+
+    if exp is None:
+        exp = re.compile(pattern, flags)
+
+    _regex_cache[pattern, flags] = exp
+    return exp
+
+def _iterfind_xml(xml, path):
+    """Iterate over the elements of an XML document found at a path of tags
+    (e.g., "devices/graphics") relative to its root element. The document is
+    parsed incrementally, so stopping early skips parsing the remainder."""
+    if not isinstance(xml, bytes):
+        xml = xml.encode("utf8")
+
+    tags, parents = path.split("/"), []
+    for event, elem in ET.iterparse(io.BytesIO(xml), ("start", "end")):
+        if event == "start":
+            parents.append(elem.tag)
+            continue
+
+        parents.pop()
+        if parents[1:] + [elem.tag] == tags:
+            yield elem
+
+class _Seen(object):
+    """Membership index for a list of configuration values. Hashable values
+    are tracked through a set, unhashable ones through a (short) list."""
+
+    def __init__(self, values=()):
+        self.hashable = set()
+        self.unhashable = []
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        try:
+            self.hashable.add(value)
+        except TypeError:
+            self.unhashable.append(value)
+
+    def __contains__(self, value):
+        try:
+            return value in self.hashable
+        except TypeError:
+            return value in self.unhashable
+
 class Configuration(object):
-    skip = (
+    skip = frozenset((
         "family", "extra",
-    )
+    ))
     # Single entry values.
-    keywords1 = (
+    keywords1 = frozenset((
         "type", "version", "magic", "campaign",
-    )
+    ))
     # Multiple entry values.
-    keywords2 = (
+    keywords2 = frozenset((
         "cnc", "url", "mutex", "user_agent", "referrer",
-    )
+    ))
     # Encryption key values.
-    keywords3 = (
+    keywords3 = frozenset((
         "des3key", "rc4key", "xorkey", "pubkey", "privkey", "iv",
-    )
+    ))
     # Normalize keys.
     mapping = {
         "cncs": "cnc",
@@ -51,26 +133,38 @@ class Configuration(object):
         "user-agent": "user_agent",
     }
 
+    # Keyword class and normalized key per key, so that add() classifies
+    # and normalizes each key with a single lookup.
+    kinds = {}
+    for _kind, _keys in (("skip", skip), ("single", keywords1),
+                         ("multiple", keywords2), ("key", keywords3)):
+        for _key in _keys:
+            kinds[_key] = _kind, _key
+    for _key, _value in mapping.items():
+        kinds[_key] = kinds[_value]
+    del _kind, _keys, _key, _value
+
     def __init__(self):
         self.entries = []
-        self.order = []
-        self.families = {}
+        self.families = collections.OrderedDict()
+        self._seen = {}
 
     def add(self, entry):
         self.entries.append(entry)
 
-        if entry["family"] not in self.families:
-            self.families[entry["family"]] = {
-                "family": entry["family"],
+        name = entry["family"]
+        if name not in self.families:
+            self.families[name] = {
+                "family": name,
             }
-            self.order.append(entry["family"])
-        family = self.families[entry["family"]]
+        family = self.families[name]
 
+        kinds = self.kinds
         for key, value in entry.items():
-            if key in self.skip or not value:
+            kind, key = kinds.get(key) or ("extra", key)
+            if kind == "skip" or not value:
                 continue
-            key = self.mapping.get(key, key)
-            if key in self.keywords1:
+            if kind == "single":
                 if family.get(key) and family[key] != value:
                     log.error(
                         "Duplicate value for %s => %r vs %r",
@@ -78,25 +172,29 @@ class Configuration(object):
                     )
                     continue
                 family[key] = value
-            elif key in self.keywords2:
-                if key not in family:
-                    family[key] = []
-                for value in make_list(value):
-                    if value and value not in family[key]:
-                        family[key].append(value)
-            elif key in self.keywords3:
-                if "key" not in family:
-                    family["key"] = {}
-                if key not in family["key"]:
-                    family["key"][key] = []
-                if value not in family["key"][key]:
-                    family["key"][key].append(value)
-            elif key not in family.get("extra", {}):
-                if "extra" not in family:
-                    family["extra"] = {}
-                family["extra"][key] = [value]
-            elif value not in family["extra"][key]:
-                family["extra"][key].append(value)
+                continue
+
+            # Multiple entry values are stored directly in the family, key
+            # and extra values in their respective sub-dictionaries.
+            if kind == "multiple":
+                values = family.setdefault(key, [])
+                index, items = key, make_list(value)
+            else:
+                values = family.setdefault(kind, {}).setdefault(key, [])
+                index, items = (kind, key), (value,)
+
+            seen = self._index(name, index, values)
+            for item in items:
+                if item and item not in seen:
+                    seen.add(item)
+                    values.append(item)
+
+    def _index(self, family, key, values):
+        """Returns the membership index for a list of family values."""
+        seen = self._seen.get((family, key))
+        if seen is None:
+            seen = self._seen[family, key] = _Seen(values)
+        return seen
 
     def get(self, family, *keys):
         r = self.families.get(family, {})
@@ -108,10 +206,7 @@ class Configuration(object):
         return self.families.get(name) or {}
 
     def results(self):
-        ret = []
-        for family in self.order:
-            ret.append(self.families[family])
-        return ret
+        return list(self.families.values())
 
 class Auxiliary(object):
     """Base abstract class for auxiliary modules."""
@@ -190,6 +285,13 @@ class Machinery(object):
         @param module_name: module name.
         """
         machinery = self.options.get(module_name)
+
+        # Defaults for machines that don't override them. The ResultServer
+        # port is only looked up if there turns out to be such a machine.
+        default_ip = config("cuckoo:resultserver:ip")
+        default_port = None
+
+        machines = []
         for vmname in machinery["machines"]:
             options = self.options.get(vmname)
 
@@ -203,18 +305,21 @@ class Machinery(object):
             if options.get("resultserver_ip"):
                 ip = options["resultserver_ip"]
             else:
-                ip = config("cuckoo:resultserver:ip")
+                ip = default_ip
 
             if options.get("resultserver_port"):
                 port = options["resultserver_port"]
             else:
-                # The ResultServer port might have been dynamically changed,
-                # get it from the ResultServer singleton. Also avoid import
-                # recursion issues by importing ResultServer here.
-                from cuckoo.core.resultserver import ResultServer
-                port = ResultServer().port
-
-            self.db.add_machine(
+                if default_port is None:
+                    # The ResultServer port might have been dynamically
+                    # changed, get it from the ResultServer singleton. Also
+                    # avoid import recursion issues by importing ResultServer
+                    # here.
+                    from cuckoo.core.resultserver import ResultServer
+                    default_port = ResultServer().port
+                port = default_port
+
+            machines.append(dict(
                 name=vmname,
                 label=options[self.LABEL],
                 ip=options.ip,
@@ -225,7 +330,10 @@ class Machinery(object):
                 snapshot=options.snapshot,
                 resultserver_ip=ip,
                 resultserver_port=port
-            )
+            ))
+
+        # Store all machines at once rather than one transaction each.
+        self.db.add_machines(machines)
 
     def _initialize_check(self):
         """Run checks against virtualization software when a machine manager
@@ -240,6 +348,7 @@ class Machinery(object):
         except NotImplementedError:
             return
 
+        labels = []
         for machine in self.machines():
             # If this machine is already in the "correct" state, then we
             # go on to the next machine.
@@ -247,16 +356,30 @@ class Machinery(object):
                     self._status(machine.label) in [self.POWEROFF, self.ABORTED]:
                 continue
 
-            # This machine is currently not in its correct state, we're going
-            # to try to shut it down. If that works, then the machine is fine.
-            try:
-                self.stop(machine.label)
-            except CuckooMachineError as e:
-                raise CuckooCriticalError(
-                    "Please update your configuration. Unable to shut '%s' "
-                    "down or find the machine in its proper state: %s" %
-                    (machine.label, e)
-                )
+            labels.append(machine.label)
+
+        # These machines are currently not in their correct state, we're
+        # going to try to shut them down. If that works, then the machines
+        # are fine. As stopping a machine mostly consists of waiting for it
+        # to power off, all of them are stopped concurrently.
+        errors = self._stop_all(labels)
+        for label in labels:
+            if label not in errors:
+                continue
+
+            # Unexpected errors are logged with their original traceback, as
+            # re-raising them here loses it on Python 2.
+            exc_value = errors[label][1]
+            if not isinstance(exc_value, CuckooMachineError):
+                log.error("Unexpected error stopping machine %s", label,
+                          exc_info=errors[label])
+                raise exc_value
+
+            raise CuckooCriticalError(
+                "Please update your configuration. Unable to shut '%s' "
+                "down or find the machine in its proper state: %s" %
+                (label, exc_value)
+            )
 
         if not config("cuckoo:timeouts:vm_state"):
             raise CuckooCriticalError(
@@ -264,6 +387,37 @@ class Machinery(object):
                 "properly, please update it to be non-null."
             )
 
+    def _stop_all(self, labels, concurrency=32):
+        """Stop multiple machines concurrently.
+        @param labels: machine names.
+        @param concurrency: maximum amount of machines stopped at once.
+        @return: dict with machine label as key and exception info, as
+                 returned by sys.exc_info(), as value for each machine that
+                 could not be stopped.
+        """
+        errors = {}
+        semaphore = threading.BoundedSemaphore(concurrency)
+
+        def stop(label):
+            try:
+                self.stop(label)
+            except Exception:
+                errors[label] = sys.exc_info()
+            finally:
+                semaphore.release()
+
+        threads = []
+        for label in labels:
+            semaphore.acquire()
+            thread = threading.Thread(target=stop, args=(label,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+        return errors
+
     def machines(self):
         """List virtual machines.
         @return: virtual machines list
@@ -416,6 +570,16 @@ class LibVirtMachinery(Machinery):
     ERROR = "machete"
     ABORTED = "abort"
 
+    # Interval at which _wait_status re-checks the status of a machine even
+    # if no lifecycle event came in, in case one got lost along the way. This
+    # matches the interval of polling, so that lost events don't slow down
+    # starting and stopping machines.
+    EVENT_RECHECK = 1
+
+    # The default libvirt event loop is process-wide and is run only once.
+    _event_loop = None
+    _event_loop_lock = threading.Lock()
+
     def __init__(self):
         if not HAVE_LIBVIRT:
             raise CuckooDependencyError(
@@ -425,6 +589,19 @@ class LibVirtMachinery(Machinery):
 
         super(LibVirtMachinery, self).__init__()
 
+        self.vms = {}
+        self._state_events = {}
+        self._events_conn = None
+        self._events_callback = None
+
+        # Shared libvirt connection, see _connection().
+        self._conn = None
+        self._conn_lock = threading.RLock()
+
+        # The event implementation has to be registered before opening any
+        # connection that should deliver events.
+        self._start_event_loop()
+
     def initialize(self, module):
         """Initialize machine manager module. Override default to set proper
         connection string.
@@ -444,6 +621,9 @@ class LibVirtMachinery(Machinery):
         # Preload VMs
         self.vms = self._fetch_machines()
 
+        # Get notified about state changes of the VMs.
+        self._register_events()
+
         # Base checks. Also attempts to shutdown any machines which are
         # currently still active.
         super(LibVirtMachinery, self)._initialize_check()
@@ -461,11 +641,10 @@ class LibVirtMachinery(Machinery):
                   "been turned off {0}".format(label)
             raise CuckooMachineError(msg)
 
-        conn = self._connect()
-
         vm_info = self.db.view_machine_by_label(label)
 
-        snapshot_list = self.vms[label].snapshotListNames(flags=0)
+        with self._connection():
+            snapshot_list = self.vms[label].snapshotListNames(flags=0)
 
         # If a snapshot is configured try to use it.
         if vm_info.snapshot and vm_info.snapshot in snapshot_list:
@@ -473,30 +652,30 @@ class LibVirtMachinery(Machinery):
             log.debug("Using snapshot {0} for virtual machine "
                       "{1}".format(vm_info.snapshot, label))
             try:
-                vm = self.vms[label]
-                snapshot = vm.snapshotLookupByName(vm_info.snapshot, flags=0)
-                self.vms[label].revertToSnapshot(snapshot, flags=0)
+                with self._connection():
+                    vm = self.vms[label]
+                    snapshot = vm.snapshotLookupByName(
+                        vm_info.snapshot, flags=0
+                    )
+                    vm.revertToSnapshot(snapshot, flags=0)
             except libvirt.libvirtError:
                 msg = "Unable to restore snapshot {0} on " \
                       "virtual machine {1}".format(vm_info.snapshot, label)
                 raise CuckooMachineError(msg)
-            finally:
-                self._disconnect(conn)
-        elif self._get_snapshot(label):
+        else:
             snapshot = self._get_snapshot(label)
+            if not snapshot:
+                raise CuckooMachineError("No snapshot found for virtual "
+                                         "machine {0}".format(label))
+
             log.debug("Using snapshot {0} for virtual machine "
                       "{1}".format(snapshot.getName(), label))
             try:
-                self.vms[label].revertToSnapshot(snapshot, flags=0)
+                with self._connection():
+                    self.vms[label].revertToSnapshot(snapshot, flags=0)
             except libvirt.libvirtError:
                 raise CuckooMachineError("Unable to restore snapshot on "
                                          "virtual machine {0}".format(label))
-            finally:
-                self._disconnect(conn)
-        else:
-            self._disconnect(conn)
-            raise CuckooMachineError("No snapshot found for virtual machine "
-                                     "{0}".format(label))
 
         # Check state.
         self._wait_status(label, self.RUNNING)
@@ -508,23 +687,19 @@ class LibVirtMachinery(Machinery):
         """
         log.debug("Stopping machine %s", label)
 
-        if self._status(label) == self.POWEROFF:
-            raise CuckooMachineError("Trying to stop an already stopped "
-                                     "machine {0}".format(label))
-
-        # Force virtual machine shutdown.
-        conn = self._connect()
+        # Force virtual machine shutdown. There's no need to query its status
+        # beforehand, an inactive machine doesn't have to be stopped.
         try:
-            if not self.vms[label].isActive():
-                log.debug("Trying to stop an already stopped machine %s. "
-                          "Skip", label)
-            else:
+            with self._connection():
+                if not self.vms[label].isActive():
+                    log.debug("Trying to stop an already stopped machine "
+                              "%s. Skip", label)
+                    return
+
                 self.vms[label].destroy()  # Machete's way!
         except libvirt.libvirtError as e:
             raise CuckooMachineError("Error stopping virtual machine "
                                      "{0}: {1}".format(label, e))
-        finally:
-            self._disconnect(conn)
         # Check state.
         self._wait_status(label, self.POWEROFF)
 
@@ -532,27 +707,37 @@ class LibVirtMachinery(Machinery):
         """Override shutdown to free libvirt handlers - they print errors."""
         super(LibVirtMachinery, self).shutdown()
 
+        self._unregister_events()
+
         # Free handlers.
         self.vms = None
 
+        with self._conn_lock:
+            if self._conn:
+                try:
+                    self._disconnect(self._conn)
+                except CuckooMachineError as e:
+                    log.warning("Error closing libvirt connection: %s", e)
+                self._conn = None
+
     def dump_memory(self, label, path):
         """Take a memory dump.
         @param path: path to where to store the memory dump.
         """
         log.debug("Dumping memory for machine %s", label)
 
-        conn = self._connect()
         try:
             # Resolve permission issue as libvirt creates the file as
             # root/root in mode 0600, preventing us from reading it. This
             # supposedly still doesn't allow us to remove it, though..
             open(path, "wb").close()
-            self.vms[label].coreDump(path, flags=libvirt.VIR_DUMP_MEMORY_ONLY)
+            with self._connection():
+                self.vms[label].coreDump(
+                    path, flags=libvirt.VIR_DUMP_MEMORY_ONLY
+                )
         except libvirt.libvirtError as e:
             raise CuckooMachineError("Error dumping memory virtual machine "
                                      "{0}: {1}".format(label, e))
-        finally:
-            self._disconnect(conn)
 
     def _status(self, label):
         """Get current status of a vm.
@@ -572,14 +757,12 @@ class LibVirtMachinery(Machinery):
         # VIR_DOMAIN_CRASHED = 6
         # VIR_DOMAIN_PMSUSPENDED = 7
 
-        conn = self._connect()
         try:
-            state = self.vms[label].state(flags=0)
+            with self._connection():
+                state = self.vms[label].state(flags=0)
         except libvirt.libvirtError as e:
             raise CuckooMachineError("Error getting status for virtual "
                                      "machine {0}: {1}".format(label, e))
-        finally:
-            self._disconnect(conn)
 
         if state:
             if state[0] == 1:
@@ -599,6 +782,179 @@ class LibVirtMachinery(Machinery):
             raise CuckooMachineError("Unable to get status for "
                                      "{0}".format(label))
 
+    def _wait_status(self, label, *states):
+        """Wait for a vm status. Rather than polling, the wait is woken up by
+        the libvirt lifecycle events of the virtual machine.
+        @param label: virtual machine name.
+        @param state: virtual machine status, accepts multiple states as list.
+        @raise CuckooMachineError: if default waiting timeout expire.
+        """
+        self._check_events()
+
+        event = self._state_events.get(label)
+        if not self._events_conn or not event:
+            return super(LibVirtMachinery, self)._wait_status(label, *states)
+
+        deadline = time.time() + config("cuckoo:timeouts:vm_state")
+        while True:
+            # Clear the event before checking the status, so that a state
+            # change in between the two wakes up the wait right away.
+            event.clear()
+            current = self._status(label)
+            if current in states:
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise CuckooMachineError(
+                    "Timeout hit while for machine %s to change status" % label
+                )
+
+            log.debug("Waiting up to %i cuckooseconds for machine %s to "
+                      "switch to status %s", remaining, label, states)
+            event.wait(min(remaining, self.EVENT_RECHECK))
+
+    @classmethod
+    def _start_event_loop(cls):
+        """Register and run the default libvirt event loop."""
+        with LibVirtMachinery._event_loop_lock:
+            if LibVirtMachinery._event_loop:
+                return
+
+            libvirt.virEventRegisterDefaultImpl()
+
+            thread = threading.Thread(target=cls._run_event_loop)
+            thread.daemon = True
+            thread.start()
+            LibVirtMachinery._event_loop = thread
+
+    @staticmethod
+    def _run_event_loop():
+        while True:
+            try:
+                libvirt.virEventRunDefaultImpl()
+            except Exception as e:
+                log.warning("Error running the libvirt event loop: %s", e)
+                time.sleep(1)
+
+    def _register_events(self):
+        """Register for lifecycle events of the virtual machines."""
+        for label in self.vms:
+            self._state_events.setdefault(label, threading.Event())
+
+        conn = self._connect()
+        try:
+            self._events_callback = conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_event, None
+            )
+        except libvirt.libvirtError as e:
+            log.warning("Unable to register for libvirt domain events, "
+                        "falling back to polling: %s", e)
+            self._disconnect(conn)
+            return
+
+        self._events_conn = conn
+
+    def _check_events(self):
+        """Register for lifecycle events again if the connection delivering
+        them has been lost."""
+        with self._conn_lock:
+            conn = self._events_conn
+            if not conn:
+                return
+
+            try:
+                if conn.isAlive():
+                    return
+            except libvirt.libvirtError:
+                pass
+
+            log.warning("Lost the libvirt events connection, registering "
+                        "for domain events again")
+            try:
+                self._unregister_events()
+            except CuckooMachineError as e:
+                log.debug("Error closing the libvirt events connection: %s", e)
+            self._events_conn = self._events_callback = None
+
+            try:
+                self._register_events()
+            except CuckooMachineError as e:
+                log.warning("Unable to register for libvirt domain events, "
+                            "falling back to polling: %s", e)
+
+    def _unregister_events(self):
+        """Unregister the lifecycle events callback."""
+        if not self._events_conn:
+            return
+
+        try:
+            self._events_conn.domainEventDeregisterAny(self._events_callback)
+        except libvirt.libvirtError as e:
+            log.debug("Error unregistering libvirt domain events: %s", e)
+
+        self._disconnect(self._events_conn)
+        self._events_conn = self._events_callback = None
+
+    def _lifecycle_event(self, conn, domain, event, detail, opaque):
+        """Wake up anyone waiting for a state change of this domain."""
+        state_event = self._state_events.get(domain.name())
+        if state_event:
+            state_event.set()
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Provide the shared libvirt connection, connecting if required.
+        The connection is dropped if it turns out to be dead, so that the
+        next call reconnects.
+        @return: libvirt connection handle.
+        """
+        with self._conn_lock:
+            if not self._conn:
+                conn = self._connect()
+
+                # Machine handles are bound to the connection they have been
+                # looked up through, so refresh them through the new
+                # connection before handing it out. If that fails the new
+                # connection is released again, so that the next call retries
+                # rather than using stale handles.
+                if self.vms:
+                    try:
+                        self.vms = self._fetch_machines(conn)
+                    except Exception:
+                        try:
+                            self._disconnect(conn)
+                        except CuckooMachineError:
+                            pass
+                        raise
+
+                self._conn = conn
+
+            conn = self._conn
+
+        try:
+            yield conn
+        except Exception:
+            self._check_connection(conn)
+            raise
+
+    def _check_connection(self, conn):
+        """Drop the shared connection if it's no longer alive.
+        @param conn: libvirt connection handle.
+        """
+        try:
+            if conn.isAlive():
+                return
+        except libvirt.libvirtError:
+            pass
+
+        log.warning("Lost the connection to libvirt, reconnecting on the "
+                    "next request")
+        with self._conn_lock:
+            if self._conn is conn:
+                self._conn = None
+
     def _connect(self):
         """Connect to libvirt subsystem.
         @raise CuckooMachineError: when unable to connect to libvirt.
@@ -622,43 +978,57 @@ class LibVirtMachinery(Machinery):
         except libvirt.libvirtError:
             raise CuckooMachineError("Cannot disconnect from libvirt")
 
-    def _fetch_machines(self):
+    def _fetch_machines(self, conn=None):
         """Fetch machines handlers.
+        @param conn: libvirt connection handle, the shared one by default.
         @return: dict with machine label as key and handle as value.
         """
+        if conn is None:
+            with self._connection() as conn:
+                return self._fetch_machines(conn)
+
+        labels = set(vm.label for vm in self.machines())
+
+        # Fetch all domains in one go rather than looking up each machine.
         vms = {}
-        for vm in self.machines():
-            vms[vm.label] = self._lookup(vm.label)
+        try:
+            for domain in conn.listAllDomains(0):
+                if domain.name() in labels:
+                    vms[domain.name()] = domain
+        except libvirt.libvirtError as e:
+            log.debug("Unable to list all libvirt domains: %s", e)
+
+        # Whatever did not show up is looked up individually, which raises
+        # a proper error for machines that don't exist.
+        for label in labels.difference(vms):
+            vms[label] = self._lookup(label, conn)
         return vms
 
-    def _lookup(self, label):
+    def _lookup(self, label, conn=None):
         """Search for a virtual machine.
-        @param conn: libvirt connection handle.
         @param label: virtual machine name.
+        @param conn: libvirt connection handle, the shared one by default.
         @raise CuckooMachineError: if virtual machine is not found.
         """
-        conn = self._connect()
         try:
-            vm = conn.lookupByName(label)
+            if conn is not None:
+                return conn.lookupByName(label)
+
+            with self._connection() as conn:
+                return conn.lookupByName(label)
         except libvirt.libvirtError:
                 raise CuckooMachineError("Cannot find machine "
                                          "{0}".format(label))
-        finally:
-            self._disconnect(conn)
-        return vm
 
     def _list(self):
         """List available virtual machines.
         @raise CuckooMachineError: if unable to list virtual machines.
         """
-        conn = self._connect()
         try:
-            names = conn.listDefinedDomains()
+            with self._connection() as conn:
+                return conn.listDefinedDomains()
         except libvirt.libvirtError:
             raise CuckooMachineError("Cannot list domains")
-        finally:
-            self._disconnect(conn)
-        return names
 
     def _version_check(self):
         """Check if libvirt release supports snapshots.
@@ -681,30 +1051,31 @@ class LibVirtMachinery(Machinery):
             @param node: config file node
             @return: extracted creation time
             """
-            xml = ET.fromstring(node.getXMLDesc(flags=0))
-            return xml.findtext("./creationTime")
+            for elem in _iterfind_xml(node.getXMLDesc(flags=0),
+                                      "creationTime"):
+                return elem.text
 
         snapshot = None
-        conn = self._connect()
         try:
-            vm = self.vms[label]
-
-            # Try to get the currrent snapshot, otherwise fallback on the latest
-            # from config file.
-            if vm.hasCurrentSnapshot(flags=0):
-                snapshot = vm.snapshotCurrent(flags=0)
-            else:
-                log.debug("No current snapshot, using latest snapshot")
+            with self._connection():
+                vm = self.vms[label]
 
-                # No current snapshot, try to get the last one from config file.
-                snapshot = sorted(vm.listAllSnapshots(flags=0),
-                                  key=_extract_creation_time,
-                                  reverse=True)[0]
+                # Try to get the currrent snapshot, otherwise fallback on the
+                # latest from config file.
+                if vm.hasCurrentSnapshot(flags=0):
+                    snapshot = vm.snapshotCurrent(flags=0)
+                else:
+                    log.debug("No current snapshot, using latest snapshot")
+
+                    # No current snapshot, try to get the last one from config
+                    # file. Each snapshot's XML description is fetched and
+                    # parsed exactly once.
+                    snapshots = vm.listAllSnapshots(flags=0)
+                    if snapshots:
+                        snapshot = max(snapshots, key=_extract_creation_time)
         except libvirt.libvirtError:
             raise CuckooMachineError("Unable to get snapshot for "
                                      "virtual machine {0}".format(label))
-        finally:
-            self._disconnect(conn)
 
         return snapshot
 
@@ -716,25 +1087,25 @@ class LibVirtMachinery(Machinery):
         pass
 
     def get_remote_control_params(self, label):
-        conn = self._connect()
-
-        try:
-            vm = conn.lookupByName(label)
+        # The handle is taken once connected, as reconnecting refreshes it.
+        with self._connection():
+            vm = self.vms.get(label) if self.vms else None
             if not vm:
                 log.warning("No such VM: %s", label)
                 return {}
 
-            port = 0
-            desc = ET.fromstring(vm.XMLDesc())
-            for elem in desc.findall("./devices/graphics"):
-                if elem.attrib.get("type") == "vnc":
-                    # Future work: passwd, listen, socket (addr:port)
-                    port = elem.attrib.get("port")
-                    if port:
-                        port = int(port)
-                        break
-        finally:
-            self._disconnect(conn)
+            desc = vm.XMLDesc()
+
+        port = 0
+        for elem in _iterfind_xml(desc, "devices/graphics"):
+            if elem.attrib.get("type") != "vnc":
+                continue
+
+            # Future work: passwd, listen, socket (addr:port)
+            port = elem.attrib.get("port")
+            if port:
+                port = int(port)
+                break
 
         if port <= 0:
             log.error("VM %s does not have a valid VNC port", label)
@@ -753,6 +1124,28 @@ class Processing(object):
     order = 1
     enabled = True
 
+    # Attributes set by set_path() and their path in the analysis folder.
+    paths = (
+        ("log_path", "analysis.log"),
+        ("cuckoolog_path", "cuckoo.log"),
+        ("dropped_path", "files"),
+        ("dropped_meta_path", "files.json"),
+        ("extracted_path", "extracted"),
+        ("package_files", "package_files"),
+        ("buffer_path", "buffer"),
+        ("logs_path", "logs"),
+        ("shots_path", "shots"),
+        ("pcap_path", "dump.pcap"),
+        ("pmemory_path", "memory"),
+        ("memory_path", "memory.dmp"),
+        ("mitmout_path", "mitm.log"),
+        ("mitmerr_path", "mitm.err"),
+        ("tlsmaster_path", "tlsmaster.txt"),
+        ("suricata_path", "suricata"),
+        ("network_path", "network"),
+        ("taskinfo_path", "task.json"),
+    )
+
     def __init__(self):
         self.analysis_path = ""
         self.baseline_path = ""
@@ -791,26 +1184,14 @@ class Processing(object):
         @param analysis_path: analysis folder path.
         """
         self.analysis_path = analysis_path
-        self.log_path = os.path.join(self.analysis_path, "analysis.log")
-        self.cuckoolog_path = os.path.join(self.analysis_path, "cuckoo.log")
-        self.file_path = os.path.realpath(os.path.join(self.analysis_path,
-                                                       "binary"))
-        self.dropped_path = os.path.join(self.analysis_path, "files")
-        self.dropped_meta_path = os.path.join(self.analysis_path, "files.json")
-        self.extracted_path = os.path.join(self.analysis_path, "extracted")
-        self.package_files = os.path.join(self.analysis_path, "package_files")
-        self.buffer_path = os.path.join(self.analysis_path, "buffer")
-        self.logs_path = os.path.join(self.analysis_path, "logs")
-        self.shots_path = os.path.join(self.analysis_path, "shots")
-        self.pcap_path = os.path.join(self.analysis_path, "dump.pcap")
-        self.pmemory_path = os.path.join(self.analysis_path, "memory")
-        self.memory_path = os.path.join(self.analysis_path, "memory.dmp")
-        self.mitmout_path = os.path.join(self.analysis_path, "mitm.log")
-        self.mitmerr_path = os.path.join(self.analysis_path, "mitm.err")
-        self.tlsmaster_path = os.path.join(self.analysis_path, "tlsmaster.txt")
-        self.suricata_path = os.path.join(self.analysis_path, "suricata")
-        self.network_path = os.path.join(self.analysis_path, "network")
-        self.taskinfo_path = os.path.join(self.analysis_path, "task.json")
+
+        # Joining with an empty component adds the trailing separator, if
+        # any is required, after which each path is a plain concatenation.
+        base = os.path.join(self.analysis_path, "")
+        for attr, filename in self.paths:
+            setattr(self, attr, base + filename)
+
+        self.file_path = os.path.realpath(base + "binary")
 
     def set_results(self, results):
         """Set the results - the fat dictionary."""
@@ -854,6 +1235,15 @@ class Signature(object):
         self.matched = False
         self._caller = caller
 
+        # IOC marks that have been added, see _mark_unique().
+        self._marks_seen = _Seen()
+
+        # Sections of the results, see _section().
+        self._sections = {}
+
+        # TTP descriptions of this signature, see extend_ttp().
+        self._ttp = None
+
         # These are set by the caller, they represent the process identifier
         # and call index respectively.
         self.pid = None
@@ -867,36 +1257,159 @@ class Signature(object):
     def _check_value(self, pattern, subject, regex=False, all=False):
         """Check a pattern against a given subject.
         @param pattern: string or expression to check for.
-        @param subject: target of the check.
+        @param subject: target of the check, a single value or any iterable
+                        of strings.
         @param regex: boolean representing if the pattern is a regular
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        ret = set()
+        # Strings and anything else that isn't iterable (e.g., None) are
+        # checked as a single value.
+        if isinstance(subject, basestring) or \
+                not hasattr(subject, "__iter__"):
+            if regex:
+                return self._check_regex_one(pattern, subject, all)
+            return self._check_literal_one(pattern, subject, all)
+        return self._check_many(pattern, subject, regex, all)
+
+    def _check_many(self, pattern, subject, regex=False, all=False):
+        """Check a pattern against an iterable of strings.
+        @param pattern: string or expression to check for.
+        @param subject: iterable of strings.
+        @param regex: whether the pattern is a regular expression.
+        @param all: whether to return all matches rather than the first one.
+        """
         if regex:
-            exp = re.compile(pattern, re.IGNORECASE)
-            if isinstance(subject, list):
-                for item in subject:
-                    if exp.match(item):
-                        ret.add(item)
-            else:
-                if exp.match(subject):
-                    ret.add(subject)
-        else:
-            if isinstance(subject, list):
-                for item in subject:
-                    if item.lower() == pattern.lower():
-                        ret.add(item)
-            else:
-                if subject == pattern:
-                    ret.add(subject)
+            return self._check_regex_many(pattern, subject, all)
+        return self._check_literal_many(pattern, subject, all)
+
+    def _check_literal_one(self, pattern, subject, all=False):
+        """Check a literal pattern against a string, case-sensitively."""
+        return self._select([subject] if subject == pattern else [], all)
+
+    def _check_regex_one(self, pattern, subject, all=False):
+        """Check a regular expression against a string."""
+        exp = _compile(pattern, re.IGNORECASE)
+        return self._select([subject] if exp.match(subject) else [], all)
+
+    def _check_literal_many(self, pattern, subject, all=False):
+        """Check a literal pattern against an iterable of strings,
+        case-insensitively. Collections built by the signature helpers go
+        through the shared lowercase index, anything else is matched
+        lazily."""
+        index = self._literal_index(subject)
+        if index is not None:
+            return self._select(index.get(pattern.lower(), ()), all)
+
+        lower = pattern.lower()
+        return self._select(
+            (item for item in subject if item.lower() == lower), all
+        )
+
+    def _check_regex_many(self, pattern, subject, all=False):
+        """Check a regular expression against an iterable of strings.
+        Matches against collections built by the signature helpers are
+        cached, anything else is matched lazily."""
+        exp = _compile(pattern, re.IGNORECASE)
+        matches = self._regex_matches(exp, subject)
+        if matches is not None:
+            return self._select(matches, all)
+
+        return self._select(
+            (item for item in subject if exp.match(item)), all
+        )
 
+    @staticmethod
+    def _select(matches, all=False):
+        """Select the result of a check from its matches.
+        @param matches: iterable of matches.
+        @param all: whether to return all matches.
+        @return: list of unique matches if all is set, otherwise the first
+                 match or None.
+        """
         # Return all elements.
         if all:
-            return list(ret)
+            return list(set(matches))
+
         # Return only the first element, if available. Otherwise return None.
-        elif ret:
-            return ret.pop()
+        for item in matches:
+            return item
+
+    def _shared_cache(self, name):
+        """Get a cache shared by all signatures of the current analysis.
+        @param name: name of the cache.
+        @return: cache dictionary.
+        """
+        caches = getattr(self._caller, "_signature_caches", None)
+        if caches is None:
+            caches = self._caller._signature_caches = {}
+        return caches.setdefault(name, {})
+
+    def _shared_subject(self, subject):
+        """Register an immutable collection of strings built by one of the
+        signature helpers, so that checks against it are cached. Collections
+        passed in by signatures may be modified in between checks and are
+        therefore never cached.
+        @param subject: tuple or frozenset of strings.
+        @return: the subject.
+        """
+        self._shared_cache("subject")[id(subject)] = subject, {}
+        return subject
+
+    def _subject_cache(self, subject):
+        """Get the cache for a collection of strings registered through
+        _shared_subject(), shared between signatures.
+        @param subject: iterable of strings.
+        @return: cache dictionary or None if the subject isn't registered.
+        """
+        # Registered subjects are kept alive by the cache itself, so their
+        # identifiers can't be reused by other objects.
+        cached = self._shared_cache("subject").get(id(subject))
+        if cached is not None:
+            return cached[1]
+
+    def _literal_index(self, subject):
+        """Index strings by their lowercase representation, so that a literal
+        pattern is checked with a single lookup.
+        @param subject: iterable of strings.
+        @return: dict with lowercase string as key and strings as value, or
+                 None if the subject isn't cached.
+        """
+        cache = self._subject_cache(subject)
+        if cache is None:
+            return None
+
+        if "literal" not in cache:
+            index = cache["literal"] = {}
+            # Plain lookups rather than setdefault(), which would allocate
+            # a throwaway list for every string.
+            get = index.get
+            for item in subject:
+                key = item.lower()
+                items = get(key)
+                if items is None:
+                    index[key] = [item]
+                else:
+                    items.append(item)
+        return cache["literal"]
+
+    def _regex_matches(self, exp, subject):
+        """Match a regular expression against strings. As signatures tend to
+        check the same expressions over and over, e.g., for each API call,
+        the matches are remembered.
+        @param exp: compiled regular expression.
+        @param subject: iterable of strings.
+        @return: list of matching strings, or None if the subject isn't
+                 cached.
+        """
+        cache = self._subject_cache(subject)
+        if cache is None:
+            return None
+
+        cache = cache.setdefault("regex", {})
+        if exp.pattern not in cache:
+            cache[exp.pattern] = [item for item in subject if exp.match(item)]
+        return cache[exp.pattern]
 
     def get_results(self, key=None, default=None):
         if key:
@@ -904,15 +1417,29 @@ class Signature(object):
 
         return self._caller.results
 
+    def _section(self, key):
+        """Get a section of the results. As the results of an analysis don't
+        change while its signatures run, the lookup is done only once.
+        @param key: name of the section, e.g., "behavior".
+        @return: section dictionary, empty if not present.
+        """
+        if key not in self._sections:
+            self._sections[key] = self.get_results(key, {})
+        return self._sections[key]
+
     def get_processes(self, name=None):
         """Get a list of processes.
 
         @param name: If set only return processes with that name.
         @return: List of processes or empty list
         """
-        for item in self.get_results("behavior", {}).get("processes", []):
-            if name is None or item["process_name"] == name:
-                yield item
+        if name is None:
+            processes = self._section("behavior").get("processes", [])
+        else:
+            processes = self._process_index("process_name").get(name, [])
+
+        for item in processes:
+            yield item
 
     def get_process_by_pid(self, pid=None):
         """Get a process by its process identifier.
@@ -920,31 +1447,83 @@ class Signature(object):
         @param pid: pid to search for.
         @return: process.
         """
-        for item in self.get_results("behavior", {}).get("processes", []):
-            if item["pid"] == pid:
-                return item
+        processes = self._process_index("pid").get(pid)
+        if processes:
+            return processes[0]
+
+    def _process_index(self, field):
+        """Index the processes by one of their fields, shared between
+        signatures.
+        @param field: process field, e.g., "pid".
+        @return: dict with field value as key and processes as value.
+        """
+        cache = self._shared_cache("processes")
+        if field not in cache:
+            index = cache[field] = {}
+            for item in self._section("behavior").get("processes", []):
+                index.setdefault(item[field], []).append(item)
+        return cache[field]
 
-    def get_summary(self, key=None, default=[]):
+    def get_summary(self, key=None, default=None):
         """Get one or all values related to the global summary."""
-        summary = self.get_results("behavior", {}).get("summary", {})
-        return summary.get(key, default) if key else summary
+        summary = self._section("behavior").get("summary", {})
+        if not key:
+            return summary
+        return summary.get(key, [] if default is None else default)
 
     def get_summary_generic(self, pid, actions):
         """Get generic info from summary.
 
         @param pid: pid of the process. None for all
         @param actions: A list of actions to get
-        """
-        ret = []
-        for process in self.get_results("behavior", {}).get("generic", []):
-            if pid is not None and process["pid"] != pid:
-                continue
+        @return: tuple of entries, shared between signatures
+        """
+        # Signatures keep asking for the same information, so the result
+        # is shared between them as a tuple. This also keeps it from being
+        # indexed over and over again for literal checks.
+        cache = self._shared_cache("summary_generic")
+        key = pid, tuple(actions)
+        if key in cache:
+            return cache[key]
+
+        if pid is None:
+            summaries = self._generic_summaries()
+        else:
+            summaries = self._generic_index().get(pid, ())
 
-            for action in actions:
-                if action in process["summary"]:
-                    ret += process["summary"][action]
+        ret = cache[key] = self._shared_subject(tuple(
+            itertools.chain.from_iterable(
+                summary.get(action, ())
+                for summary in summaries
+                for action in actions
+            )
+        ))
         return ret
 
+    def _generic_summaries(self):
+        """Get the summaries of the generic behavior, in order.
+        @return: list of summary dictionaries.
+        """
+        cache = self._shared_cache("generic_index")
+        if "all" not in cache:
+            generic = self._section("behavior").get("generic", [])
+            cache["all"] = [process["summary"] for process in generic]
+        return cache["all"]
+
+    def _generic_index(self):
+        """Index the generic behavior summary by process in a single pass,
+        shared between signatures. The summaries of a process keep the order
+        of the generic behavior, also if its pid shows up more than once.
+        @return: dict with the pid as key and a list of summaries as value.
+        """
+        cache = self._shared_cache("generic_index")
+        if "pid" not in cache:
+            index = cache["pid"] = {}
+            generic = self._section("behavior").get("generic", [])
+            for process in generic:
+                index.setdefault(process["pid"], []).append(process["summary"])
+        return cache["pid"]
+
     def get_files(self, pid=None, actions=None):
         """Get files read, queried, or written to optionally by a
         specific process.
@@ -1006,10 +1585,10 @@ class Signature(object):
                 "file_exists", "file_failed",
             ]
 
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_files(pid, actions),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_files(pid, actions),
+                                regex=regex,
+                                all=all)
 
     def check_dll_loaded(self, pattern, regex=False, actions=None, pid=None,
                          all=False):
@@ -1021,10 +1600,10 @@ class Signature(object):
                     processes will be checked.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_dll_loaded(pid),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_dll_loaded(pid),
+                                regex=regex,
+                                all=all)
 
     def check_command_line(self, pattern, regex=False, all=False):
         """Check for a command line being opened.
@@ -1033,10 +1612,10 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_summary("command_line"),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_summary("command_line"),
+                                regex=regex,
+                                all=all)
 
     def check_key(self, pattern, regex=False, actions=None, pid=None,
                   all=False):
@@ -1055,15 +1634,15 @@ class Signature(object):
                 "regkey_read", "regkey_deleted",
             ]
 
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_keys(pid, actions),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_keys(pid, actions),
+                                regex=regex,
+                                all=all)
 
     def get_mutexes(self, pid=None):
         """
         @param pid: Pid to filter for
-        @return:List of mutexes
+        @return:Tuple of mutexes
         """
         return self.get_summary_generic(pid, ["mutex"])
 
@@ -1074,25 +1653,32 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_mutexes(),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_mutexes(),
+                                regex=regex,
+                                all=all)
 
     def get_command_lines(self):
         """Retrieve all command lines used."""
         return self.get_summary("command_line")
     
     def get_target_generic(self, subtype):
-        return self.get_results("target", {}).get(subtype, {})
+        return self._section("target").get(subtype, {})
 
     def get_target_file_hash(self):
-        file_hash = []
-        if self.get_target_generic("category") == "file":
-            file_hash.append(self.get_target_generic("file")["md5"])
-            file_hash.append(self.get_target_generic("file")["sha1"])
-            file_hash.append(self.get_target_generic("file")["sha256"])
-        return file_hash
+        """Return the MD5, SHA1, and SHA256 hashes of the target file. The
+        same tuple is returned every time, so that checks against it can
+        make use of the shared caches of _check_value()."""
+        cache = self._shared_cache("target")
+        if "file_hash" not in cache:
+            if self.get_target_generic("category") == "file":
+                target = self.get_target_generic("file")
+                cache["file_hash"] = self._shared_subject((
+                    target["md5"], target["sha1"], target["sha256"],
+                ))
+            else:
+                cache["file_hash"] = ()
+        return cache["file_hash"]
 
     def get_wmi_queries(self):
         """Retrieve all executed WMI queries."""
@@ -1103,7 +1689,22 @@ class Signature(object):
 
         @param subtype: subtype string to search for.
         """
-        return self.get_results("network", {}).get(subtype, [])
+        return self._section("network").get(subtype, [])
+
+    def _net_unique(self, subtype, key):
+        """Get the unique values of a field in network data. These are
+        gathered once and then shared between signatures.
+
+        @param subtype: subtype string to search for.
+        @param key: field of the network data entries.
+        @return: frozenset of unique values.
+        """
+        cache = self._shared_cache("net_unique")
+        if (subtype, key) not in cache:
+            cache[subtype, key] = self._shared_subject(frozenset(
+                item[key] for item in self.get_net_generic(subtype)
+            ))
+        return cache[subtype, key]
 
     def get_net_hosts(self):
         """Return a list of all hosts."""
@@ -1151,20 +1752,26 @@ class Signature(object):
         volatility = self.get_results("memory", {})
         return volatility if module is None else volatility.get(module, {})
 
-    def get_apkinfo(self, section=None, default={}):
+    def get_apkinfo(self, section=None, default=None):
         """Return the apkinfo results for this analysis."""
         apkinfo = self.get_results("apkinfo", {})
-        return apkinfo if section is None else apkinfo.get(section, default)
+        if section is None:
+            return apkinfo
+        return apkinfo.get(section, {} if default is None else default)
 
-    def get_droidmon(self, section=None, default={}):
+    def get_droidmon(self, section=None, default=None):
         """Return the droidmon results for this analysis."""
         droidmon = self.get_results("droidmon", {})
-        return droidmon if section is None else droidmon.get(section, default)
+        if section is None:
+            return droidmon
+        return droidmon.get(section, {} if default is None else default)
 
-    def get_googleplay(self, section=None, default={}):
+    def get_googleplay(self, section=None, default=None):
         """Return the Google Play results for this analysis."""
         googleplay = self.get_results("googleplay", {})
-        return googleplay if section is None else googleplay.get(section, default)
+        if section is None:
+            return googleplay
+        return googleplay.get(section, {} if default is None else default)
 
     def check_ip(self, pattern, regex=False, all=False):
         """Check for an IP address being contacted.
@@ -1174,10 +1781,10 @@ class Signature(object):
         @return: boolean with the result of the check.
         """
         # logging.warning(self.get_net_hosts())
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_net_hosts(),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_net_hosts(),
+                                regex=regex,
+                                all=all)
 
     def check_hash(self, pattern, regex=False, all=False):
         """Check for a file's hash.
@@ -1188,10 +1795,10 @@ class Signature(object):
         """
         # logging.warning(self.get_target_file_hash())
         # logging.warning("--")
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_target_file_hash(),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self.get_target_file_hash(),
+                                regex=regex,
+                                all=all)
 
     def check_domain(self, pattern, regex=False, all=False):
         """Check for a domain being contacted.
@@ -1200,14 +1807,10 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        domains = set()
-        for item in self.get_net_domains():
-            domains.add(item["domain"])
-
-        return self._check_value(pattern=pattern,
-                                 subject=list(domains),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self._net_unique("domains", "domain"),
+                                regex=regex,
+                                all=all)
 
     def check_url(self, pattern, regex=False, all=False):
         """Check for a URL being contacted.
@@ -1216,22 +1819,19 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        urls = set()
-        for item in self.get_net_http():
-            urls.add(item["uri"])
-
-        return self._check_value(pattern=pattern,
-                                 subject=list(urls),
-                                 regex=regex,
-                                 all=all)
+        return self._check_many(pattern=pattern,
+                                subject=self._net_unique("http", "uri"),
+                                regex=regex,
+                                all=all)
 
     def check_suricata_alerts(self, pattern):
         """Check for pattern in Suricata alert signature
         @param pattern: string or expression to check for.
         @return: True/False
         """
+        exp = _compile(pattern, re.I)
         for alert in self.get_results("suricata", {}).get("alerts", []):
-            if re.findall(pattern, alert.get("signature", ""), re.I):
+            if exp.search(alert.get("signature", "")):
                 return True
         return False
 
@@ -1271,9 +1871,7 @@ class Signature(object):
         # logging.warning(infoSource)
         # logging.warning(ioc)
 
-        # Prevent duplicates.
-        if mark not in self.marks:
-            self.marks.append(mark)
+        self._mark_unique(mark)
 
     def mark_ioc(self, category, ioc, infoSource = None, description = None):
         """Mark an IOC as explanation as to why the current signature
@@ -1286,9 +1884,19 @@ class Signature(object):
             "description": description,
         }
 
-        # Prevent duplicates.
-        if mark not in self.marks:
-            self.marks.append(mark)
+        self._mark_unique(mark)
+
+    def _mark_unique(self, mark):
+        """Add a mark, unless an identical one is present already."""
+        # Only marks that have been added before can be duplicates, in
+        # which case the list of marks is checked, as it may have been
+        # modified in the meantime.
+        key = tuple(sorted(mark.items()))
+        if key in self._marks_seen and mark in self.marks:
+            return
+
+        self._marks_seen.add(key)
+        self.marks.append(mark)
 
     def mark_vol(self, plugin, **kwargs):
         """Mark output of a Volatility plugin as explanation as to why the
@@ -1373,10 +1981,12 @@ class Signature(object):
 
     def extend_ttp(self):
         """Find the short and long descriptions for the TTPs of a signature"""
-        d = {}
-        for t in self.ttp:
-            d[t] = self._caller.ttp_descriptions.get(t)
-        return d
+        # The TTPs of a signature and their descriptions don't change, so
+        # the mapping is only built once.
+        if self._ttp is None:
+            descriptions = self._caller.ttp_descriptions
+            self._ttp = dict((t, descriptions.get(t)) for t in self.ttp)
+        return self._ttp
 
     def results(self):
         """Turn this signature into actionable results."""
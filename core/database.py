@@ -581,26 +581,17 @@ class Database(object):
         finally:
             session.close()
 
-    @classlock
-    def add_machine(self, name, label, ip, platform, options, tags, interface,
-                    snapshot, resultserver_ip, resultserver_port):
-        """Add a guest machine.
-        @param name: machine id
-        @param label: machine label
-        @param ip: machine IP address
-        @param platform: machine supported platform
-        @param tags: list of comma separated tags
-        @param interface: sniffing interface for this machine
-        @param snapshot: snapshot name to use instead of the current one, if configured
-        @param resultserver_ip: IP address of the Result Server
-        @param resultserver_port: port of the Result Server
+    def _machine(self, session, name, label, ip, platform, options, tags,
+                 interface, snapshot, resultserver_ip, resultserver_port):
+        """Create a guest machine row, see add_machine() for the arguments.
+        @param session: SQLAlchemy session object
+        @return: machine instance
         """
         if options is None:
             options = []
         if not isinstance(options, (tuple, list)):
             options = options.split()
 
-        session = self.Session()
         machine = Machine(name=name,
                           label=label,
                           ip=ip,
@@ -617,9 +608,28 @@ class Database(object):
                 if tag.strip():
                     tag = self._get_or_create(session, Tag, name=tag.strip())
                     machine.tags.append(tag)
-        session.add(machine)
+        return machine
 
+    @classlock
+    def add_machine(self, name, label, ip, platform, options, tags, interface,
+                    snapshot, resultserver_ip, resultserver_port):
+        """Add a guest machine.
+        @param name: machine id
+        @param label: machine label
+        @param ip: machine IP address
+        @param platform: machine supported platform
+        @param tags: list of comma separated tags
+        @param interface: sniffing interface for this machine
+        @param snapshot: snapshot name to use instead of the current one, if configured
+        @param resultserver_ip: IP address of the Result Server
+        @param resultserver_port: port of the Result Server
+        """
+        session = self.Session()
         try:
+            session.add(self._machine(
+                session, name, label, ip, platform, options, tags, interface,
+                snapshot, resultserver_ip, resultserver_port
+            ))
             session.commit()
         except SQLAlchemyError as e:
             log.exception("Database error adding machine: {0}".format(e))
@@ -627,6 +637,31 @@ class Database(object):
         finally:
             session.close()
 
+    @classlock
+    def add_machines(self, machines):
+        """Add multiple guest machines in a single transaction. Should that
+        fail, the machines are added one by one instead, so that a single
+        faulty machine doesn't keep the other ones from being registered.
+        @param machines: list of dicts with the add_machine() arguments
+        """
+        session = self.Session()
+        try:
+            for machine in machines:
+                session.add(self._machine(session, **machine))
+            session.commit()
+            return
+        except SQLAlchemyError as e:
+            log.warning(
+                "Database error adding machines, adding them one by one "
+                "instead: %s", e
+            )
+            session.rollback()
+        finally:
+            session.close()
+
+        for machine in machines:
+            self.add_machine(**machine)
+
     @classlock
     def set_status(self, task_id, status):
         """Set task status.